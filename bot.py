@@ -3,6 +3,7 @@
 from __future__ import print_function
 import re
 import random
+from functools import reduce
 
 class PrefixError(Exception):
     """Raised when the prefix of the message does not match."""
@@ -12,6 +13,10 @@ class ParserError(Exception):
     """Raised when the parser attempts to parse garbage."""
 
 
+class BudgetError(ParserError):
+    """Raised when a message costs more than its budget allows."""
+
+
 class ParserGraft(object):
     """Graft objects that parsers modify to keep track of parsed tokens."""
     __slots__ = ('value', 'index')
@@ -27,12 +32,65 @@ class ParserGraft(object):
             )
 
 
+class ParserBudget(object):
+    """Work limits shared by all dispatches, counting how often each is hit."""
+    __slots__ = ('maxlength', 'maxtokens', 'maxsteps', 'maxrepeat', 'hits')
+
+    def __init__(
+            self, maxlength=512, maxtokens=64, maxsteps=1024, maxrepeat=32
+            ):
+        self.maxlength = maxlength
+        self.maxtokens = maxtokens
+        self.maxsteps = maxsteps
+        self.maxrepeat = maxrepeat
+        self.hits = dict.fromkeys(('length', 'tokens', 'steps', 'repeat'), 0)
+
+    def __repr__(self):
+        return (
+            '%s(%d, %d, %d, %d)'
+            % (self.__class__.__name__, self.maxlength,
+               self.maxtokens, self.maxsteps, self.maxrepeat)
+            )
+
+    def exceed(self, limit):
+        """Counts a hit on the named limit and ends the parse."""
+        self.hits[limit] += 1
+        raise BudgetError('Message exceeds the %s budget' % limit)
+
+
+class TokenList(list):
+    """Token list that carries its parse's budget and the steps spent."""
+    __slots__ = ('budget', 'steps')
+
+    def __init__(self, tokens, budget):
+        list.__init__(self, tokens)
+        self.budget = budget
+        self.steps = 0
+
+
+def charge(tokens):
+    """Charges a parse step to the token list's budget, if it has one."""
+    budget = getattr(tokens, 'budget', None)
+    if budget is not None:
+        tokens.steps += 1
+        if tokens.steps > budget.maxsteps:
+            budget.exceed('steps')
+
+
 class BaseParser(object):
     __slots__ = ()
 
     def __call__(self, tokens, seek=0):
         NotImplemented
 
+    def first(self):
+        """Returns the keys a match can start with, and if it can be empty.
+
+        Keys are ('item', value), ('caps', lowercased value) or ('tags', tag)
+        pairs; None stands for keys that cannot be known ahead of a parse.
+        """
+        return None, True
+
     def __add__(self, other):
         return ConcatParser(self, other)
 
@@ -53,7 +111,11 @@ class ItemParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.ref)
 
+    def first(self):
+        return frozenset((('item', self.ref),)), False
+
     def __call__(self, tokens, seek=0):
+        charge(tokens)
         try:
             if tokens[seek][0] == self.ref:
                 return ParserGraft(tokens[seek][0], seek+1)
@@ -72,7 +134,11 @@ class CapsParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.ref)
 
+    def first(self):
+        return frozenset((('caps', self.ref.lower()),)), False
+
     def __call__(self, tokens, seek=0):
+        charge(tokens)
         try:
             if tokens[seek][0].lower() == self.ref.lower():
                 return ParserGraft(tokens[seek][0], seek+1)
@@ -91,7 +157,11 @@ class TagsParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.tag)
 
+    def first(self):
+        return frozenset((('tags', self.tag),)), False
+
     def __call__(self, tokens, seek=0):
+        charge(tokens)
         try:
             if tokens[seek][1] == self.tag:
                 return ParserGraft(tokens[seek][0], seek+1)
@@ -134,6 +204,15 @@ class ConcatParser(BaseParser):
             rstr = '(%r)' % self.rexp
         return lstr + ' + ' + rstr
 
+    def first(self):
+        lkeys, lnull = self.lexp.first()
+        if not lnull:
+            return lkeys, False
+        rkeys, rnull = self.rexp.first()
+        if lkeys is None or rkeys is None:
+            return None, rnull
+        return lkeys | rkeys, rnull
+
     def __call__(self, tokens, seek=0):
         lans = self.lexp(tokens, seek)
         if lans:
@@ -148,12 +227,20 @@ class ConcatParser(BaseParser):
 
 
 class SelectParser(BaseParser):
-    """Parses the first expression if valid, otherwise the second."""
-    __slots__ = ('lexp', 'rexp')
+    """Parses the first expression if valid, otherwise the second.
+
+    Chained choices are flattened into one list of alternatives, indexed by
+    the keys each can start with, so only those that could match the next
+    token are tried, in their original order. The table is built once, so
+    the expressions should not be replaced after construction.
+    """
+    __slots__ = ('lexp', 'rexp', 'alts', 'table', 'misses')
 
     def __init__(self, lexp, rexp):
         self.lexp = lexp
         self.rexp = rexp
+        self.misses = 0
+        self.build()
 
     def __repr__(self):
         if (isinstance(self.lexp, self.__class__)
@@ -170,8 +257,65 @@ class SelectParser(BaseParser):
             rstr = '(%r)' % self.rexp
         return lstr + ' | ' + rstr
 
+    def first(self):
+        lkeys, lnull = self.lexp.first()
+        rkeys, rnull = self.rexp.first()
+        if lkeys is None or rkeys is None:
+            return None, lnull or rnull
+        return lkeys | rkeys, lnull or rnull
+
+    def build(self):
+        """Builds the lookahead table from the alternatives' first keys."""
+        # Chained choices were already flattened when they were built.
+        alts = []
+        for expr in (self.lexp, self.rexp):
+            if isinstance(expr, SelectParser):
+                alts.extend(expr.alts)
+            else:
+                alts.append(expr)
+        # Alternatives with unknown or empty starts are viable anywhere,
+        # and are kept under None to be merged into every lookup.
+        table = {None: []}
+        for index, expr in enumerate(alts):
+            keys, null = expr.first()
+            if keys is None or null:
+                table[None].append(index)
+            else:
+                for key in keys:
+                    table.setdefault(key, []).append(index)
+        fallback = table[None]
+        self.table = dict(
+            (key, tuple(sorted(set(indices).union(fallback))))
+            for key, indices in table.items()
+            )
+        self.alts = alts
+
     def __call__(self, tokens, seek=0):
-        return self.lexp(tokens, seek) or self.rexp(tokens, seek)
+        table = self.table
+        try:
+            value, tag = tokens[seek]
+        except IndexError:
+            candidates = table[None]
+        else:
+            hits = [
+                table[key]
+                for key in (
+                    ('item', value), ('caps', value.lower()), ('tags', tag),
+                    )
+                if key in table
+                ]
+            if not hits:
+                candidates = table[None]
+            elif len(hits) == 1:
+                candidates = hits[0]
+            else:
+                candidates = sorted(set().union(*hits))
+        for index in candidates:
+            graft = self.alts[index](tokens, seek)
+            if graft:
+                return graft
+            self.misses += 1
+        return None
 
 
 class WrapprParser(BaseParser):
@@ -197,6 +341,9 @@ class WrapprParser(BaseParser):
             rstr = '(%r)' % self.func
         return lstr + ' ^ ' + rstr
 
+    def first(self):
+        return self.expr.first()
+
     def __call__(self, tokens, seek=0):
         value = self.expr(tokens, seek)
         if value:
@@ -214,6 +361,9 @@ class OptionParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.expr)
 
+    def first(self):
+        return self.expr.first()[0], True
+
     def __call__(self, tokens, seek=0):
         return self.expr(tokens, seek) or ParserGraft(None, seek)
 
@@ -228,6 +378,9 @@ class StrictParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.expr)
 
+    def first(self):
+        return self.expr.first()
+
     def __call__(self, tokens, seek=0):
         value = self.expr(tokens, seek)
         if value and value.index == len(tokens):
@@ -245,13 +398,19 @@ class RepeatParser(BaseParser):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__, self.expr)
 
+    def first(self):
+        return self.expr.first()
+
     def __call__(self, tokens, seek=0):
         graft = self.expr(tokens, seek)
         if not graft:
             return None
+        budget = getattr(tokens, 'budget', None)
         graftlist = []
         while graft:
             graftlist.append(graft.value)
+            if budget is not None and len(graftlist) > budget.maxrepeat:
+                budget.exceed('repeat')
             index = graft.index
             graft = self.expr(tokens, index)
         return ParserGraft(graftlist, index)
@@ -332,7 +491,7 @@ def dice_roller():
 
 class CommandDispatcher(object):
     """Dispatches commands based on predetermined command functions."""
-    __slots__ = ('prefix',)
+    __slots__ = ('prefix', 'budget')
     __patterns = [
         (re.compile(pattern), tag)
         for pattern, tag in (
@@ -350,47 +509,77 @@ class CommandDispatcher(object):
         # Add more command name entries here...
         }
 
-    def __init__(self, prefix):
+    def __init__(self, prefix, budget=None):
         self.prefix = prefix
+        if budget is None:
+            budget = ParserBudget()
+        self.budget = budget
 
-    def tokenize(self, msg):
-        """Built-in lexer."""
+    def lex(self, msg):
+        """Built-in lexer, yielding tokens only as they are asked for."""
         match = re.match(re.escape(self.prefix), msg)
         if not match:
             raise PrefixError('Prefix does not match')
         # Only proceed if prefix matched.
-        tokens = []
         seek = match.end(0)
         msglen = len(msg)
-        # Build token list
         while seek < msglen:
-            oldseek = seek
             for pattern, tag in self.__patterns:
                 match = pattern.match(msg, seek)
                 if match:
-                    if tag:
-                        tokens.append((match.group(0), tag))
                     seek = match.end(0)
+                    if tag:
+                        yield match.group(0), tag
                     break
             else:
                 raise SyntaxError('Bad character: %s' % msg[seek])
-        return tokens
+
+    def tokenize(self, msg):
+        """Builds the full token list of a message."""
+        return list(self.lex(msg))
 
     def dispatch(self, msg):
         """Handles execution flow, dispatching the correct function."""
+        if len(msg) > self.budget.maxlength:
+            # Only lex as far as the longest command name could reach.
+            longest = max(len(name) for name in self.__commands)
+            head = msg[:len(self.prefix) + longest + 1]
+            try:
+                name = next(self.lex(head), (None, None))[0]
+            except (PrefixError, SyntaxError):
+                return msg
+            if name not in self.__commands:
+                return msg
+            try:
+                self.budget.exceed('length')
+            except BudgetError as exc:
+                return exc.args[0]
+        lexer = self.lex(msg)
         try:
-            tokens = self.tokenize(msg)
+            name = next(lexer, (None, None))[0]
         except PrefixError:
             return msg
         except SyntaxError as exc:
             return exc.args[0]
-        try:
-            graft = self.__commands[tokens[0][0]](tokens[1:])
-        except KeyError:
+        if name not in self.__commands:
             return msg
+        command = self.__commands[name]
+        # Only charge the budgets once the message is known to be a command.
+        try:
+            tokens = []
+            for token in lexer:
+                tokens.append(token)
+                # The command name counts against the token budget too.
+                if len(tokens) >= self.budget.maxtokens:
+                    self.budget.exceed('tokens')
+            graft = command(TokenList(tokens, self.budget))
+        except SyntaxError as exc:
+            return exc.args[0]
+        except BudgetError as exc:
+            return exc.args[0]
         if graft:
             return graft.value
-        return self.__commands[tokens[0][0]].func.__doc__
+        return command.func.__doc__
 
 
 bot = CommandDispatcher('>')
@@ -412,3 +601,40 @@ if __name__ == '__main__':
 
     print(bot.dispatch('>roll 100d8+8'))
     print(bot.dispatch('>roll 8d200+8'))
+
+    # Budgets only apply to commands; other messages pass through.
+    print(bot.dispatch('>' + 'a ' * 70) == '>' + 'a ' * 70)
+    print(bot.dispatch('>roll 8d8+8' + ' ' * 512))
+    print(bot.dispatch('>roll' + ' 8' * 70))
+    maxsteps, bot.budget.maxsteps = bot.budget.maxsteps, 2
+    print(bot.dispatch('>roll 8d8+8'))
+    bot.budget.maxsteps = maxsteps
+    try:
+        RepeatParser(TagsParser('INT'))(
+            TokenList([('8', 'INT')] * 40, bot.budget)
+            )
+    except BudgetError as exc:
+        print(exc.args[0])
+    print(bot.budget.hits)
+
+    # Lookahead: compare failed sub-parses against ordered trial, which
+    # alternatives with unknown first keys always fall back to.
+    alts = [
+        ItemParser('go'), ItemParser('look'), CapsParser('take'),
+        CapsParser('drop'), ItemParser('stop'),
+        ]
+    grammar = reduce(SelectParser, alts)
+    ordered = reduce(
+        SelectParser,
+        [UnLazyParser(lambda expr=expr: expr) for expr in alts]
+        )
+    budget = ParserBudget()
+    for word in ('go', 'Drop', 'stop'):
+        for name, parser in (('lookahead', grammar), ('ordered', ordered)):
+            tokens = TokenList([(word, 'WORD')], budget)
+            parser(tokens)
+            print('%s: %s %d steps' % (word, name, tokens.steps))
+    print(
+        'misses: lookahead %d, ordered %d'
+        % (grammar.misses, ordered.misses)
+        )